@@ -31,14 +31,28 @@ import re
 import io
 import sys
 import math
+import shutil
 import codecs
-import chardet
 import argparse
+import threading
+import concurrent.futures
+
+# cchardet's a good deal faster than chardet, if it happens to be installed,
+# though detection hardly ever actually runs anymore (see TextProcessor).
+try:
+    import cchardet as chardet
+except ImportError:
+    import chardet
 
 # We use the `match` statement introduced in 3.10
 if sys.version_info < (3, 10):
     raise RuntimeError('This utility requires at least Python 3.10')
 
+# Macro names are plain lowercase-plus-underscore; re.ASCII saves the engine
+# from consulting the Unicode tables for the character class.  (Compiled here
+# at module level so the hot loop doesn't even pay for an attribute lookup.)
+macro_name_re = re.compile(r'[a-z_]+', re.ASCII)
+
 class Action:
     """
     Base Action class to process our templates; unusuable on
@@ -111,15 +125,22 @@ class ActionScaleInt(Action):
             self.scale = 1/scale
         else:
             self.scale = scale
+        # The same default value tends to show up many times in the
+        # templates, so remember what we've already computed.
+        self._cache = {}
 
     def _desc(self):
         return f'Scale by {self.scale}'
 
     def _process(self, name, default):
+        if (cached := self._cache.get(default)) is not None:
+            return cached
         new_val = float(default) * self.scale
         # I like this better than the `round()` builtin because it handles .5
         # how I'd like.
-        return math.floor(new_val + 0.5)
+        result = math.floor(new_val + 0.5)
+        self._cache[default] = result
+        return result
 
 class ActionScaleFloat(ActionScaleInt):
     """
@@ -134,14 +155,18 @@ class ActionScaleFloat(ActionScaleInt):
         """
         super().__init__(scale, inverse=inverse, use_default=use_default)
         self.precision = precision
+        self._desc_fstring = f'Scale by {{:0.{precision}f}} as a float'
 
     def _desc(self):
-        fstring = f'Scale by {{:0.{self.precision}f}} as a float'
-        return fstring.format(self.scale)
+        return self._desc_fstring.format(self.scale)
 
     def _process(self, name, default):
+        if (cached := self._cache.get(default)) is not None:
+            return cached
         new_val = float(default) * self.scale
-        return round(new_val, self.precision)
+        result = round(new_val, self.precision)
+        self._cache[default] = result
+        return result
 
 class ActionHardcode(Action):
     """
@@ -354,49 +379,69 @@ class TextProcessor:
     two file encodings I've seen in the Hades data so far.  Meh.
     """
 
-    def __init__(self, filename_orig, filename_new):
+    # The only encodings we're willing to deal with, mapped to the codec
+    # we'll encode/decode with and the BOM bytes (if any)
+    encoding_table = {
+            'UTF-8-SIG': ('utf-8', codecs.BOM_UTF8),
+            'ascii': ('ascii', None),
+            }
+
+    def __init__(self, filename_orig, filename_new, raw=None):
+        """
+        If the caller's already read the original file's bytes (as
+        `App.process_file` has, to check for macros), they can be passed
+        in via `raw` to avoid reading the file a second time.
+        """
         self.filename_orig = filename_orig
         self.filename_new = filename_new
         self.written_line = False
 
-        # Grab encoding
-        with open(self.filename_orig, 'rb') as df:
-            results = chardet.detect(df.read(1024))
+        # Read the file in exactly once (if the caller hasn't already).  The
+        # only two encodings we support are trivially recognizable from the
+        # raw bytes themselves, so we can skip charset detection entirely for
+        # basically every file; the incremental detector only kicks in for
+        # the weird stuff (which we're going to end up rejecting below
+        # anyway).
+        if raw is None:
+            with open(self.filename_orig, 'rb') as df:
+                raw = df.read()
+        if raw.startswith(codecs.BOM_UTF8):
+            self.orig_encoding = 'UTF-8-SIG'
+        elif raw.isascii():
+            self.orig_encoding = 'ascii'
+        else:
+            detector = chardet.UniversalDetector()
+            for idx in range(0, len(raw), 4096):
+                detector.feed(raw[idx:idx+4096])
+                if detector.done:
+                    break
+            detector.close()
+            results = detector.result
             if results['confidence'] < 0.9:
                 raise RuntimeError(f'Character detection not confident enough for {self.filename_orig}: {results}')
             self.orig_encoding = results['encoding']
 
         # Process encoding
-        match self.orig_encoding:
-            case 'UTF-8-SIG':
-                self.encoding = 'utf-8'
-                self.bom = codecs.BOM_UTF8
-            case 'ascii':
-                self.encoding = 'ascii'
-                self.bom = None
-            case _:
-                raise RuntimeError(f'Unknown encoding in {self.filename_orig}: {self.orig_encoding}')
-
-        # Read in the file data.  Inefficient!
-        with open(self.filename_orig) as df:
-            # Note that the universal-newline handling means that our line ending will
-            # always be the single \n char.
-            df.readline()
-            if df.newlines is None:
-                raise RuntimeError(f'Unknown line endings for {self.filename_orig}')
-            self.newline = df.newlines.encode(self.encoding)
-            df.seek(0)
-            self.data = []
-            first = True
-            for line in df:
-                if first:
-                    first = False
-                    if self.bom is not None:
-                        self.data.append(line[len(self.bom.decode(self.encoding)):-1])
-                    else:
-                        self.data.append(line[:-1])
-                else:
-                    self.data.append(line[:-1])
+        try:
+            self.encoding, self.bom = self.encoding_table[self.orig_encoding]
+        except KeyError:
+            raise RuntimeError(f'Unknown encoding in {self.filename_orig}: {self.orig_encoding}') from None
+
+        # Figure out the newline style from the raw bytes, rather than relying
+        # on text-mode universal-newline handling.
+        if b'\r\n' in raw:
+            self.newline = b'\r\n'
+        elif b'\n' in raw:
+            self.newline = b'\n'
+        else:
+            raise RuntimeError(f'Unknown line endings for {self.filename_orig}')
+
+        # Strip the BOM (if we have one) and decode; lines get sliced out
+        # of the decoded text on demand, in __iter__.
+        if self.bom is not None:
+            raw = raw.removeprefix(self.bom)
+        self._raw_text = raw.decode(self.encoding)
+        self._encode = codecs.getencoder(self.encoding)
         self.odf = None
 
     def __enter__(self):
@@ -404,30 +449,44 @@ class TextProcessor:
         Support/require opening in a `with` clause
         """
         self.odf = open(self.filename_new, 'wb')
+        self._buf = bytearray()
         if self.bom is not None:
-            self.odf.write(self.bom)
+            self._buf += self.bom
         return self
 
     def __exit__(self, exit_type, value, traceback):
         """
-        Exiting from a `with` clause
+        Exiting from a `with` clause; this is where the output actually
+        gets written out, in a single go.
         """
+        self.odf.write(self._buf)
         self.odf.close()
 
     def __iter__(self):
         """
-        Iterate over the original file lines
+        Iterate over the original file lines, slicing them out of the
+        decoded text as we go rather than materializing a whole second
+        copy of the file as a list.
         """
-        return iter(self.data)
+        text = self._raw_text
+        start = 0
+        while (idx := text.find('\n', start)) != -1:
+            end = idx
+            if idx > start and text[idx-1] == '\r':
+                end = idx - 1
+            yield text[start:end]
+            start = idx + 1
+        if start < len(text):
+            yield text[start:]
 
     def write(self, text):
         """
-        Write out a single line of text
+        Write out a single line of text (to our in-memory buffer; the
+        file itself gets written on `with` exit)
         """
         if self.written_line:
-            self.odf.write(self.newline)
-        encoded = text.encode(self.encoding)
-        self.odf.write(text.encode(self.encoding))
+            self._buf += self.newline
+        self._buf += self._encode(text)[0]
         self.written_line = True
 
 class App:
@@ -436,22 +495,92 @@ class App:
     set of changes, process them!
     """
 
-    macro_re = re.compile('^(?P<start>.*)@(?P<name>[a-z_]+)\|(?P<default>.*?)@(?P<end>.*)$')
     required_macros = {'tartarus_encounters'}
 
     def __init__(self, template_dir, live_dir, changes):
         self.template_dir = template_dir
         self.live_dir = live_dir
         self.changes = changes
-        self.default_action = ActionDefault()
+        self._print_lock = threading.Lock()
+        self._compile_changes()
+        # Templates tend to repeat the same default value for a given macro
+        # over and over, so cache the stringified results rather than
+        # re-running the action (and str()) for every single occurrence.
+        self._value_cache = {}
+
+    def _compile_changes(self):
+        """
+        Pre-resolve each action in our changes dict down to a plain
+        `default -> str` callable, cutting a few layers of method dispatch
+        out of the per-macro hot path.  We build one table for normal
+        processing and a separate one for `use_defaults` runs, since some
+        actions return computed text even when defaulted.
+        """
+        self._resolvers = {}
+        self._defaults_resolvers = {}
+        for name, action in self.changes.items():
+            self._resolvers[name] = self._compile_action(name, action, False)
+            self._defaults_resolvers[name] = self._compile_action(name, action, True)
+
+    @staticmethod
+    def _compile_action(name, action, use_default):
+        """
+        Turn a single Action into a `default -> str` callable.
+        """
+        if type(action).process is not Action.process:
+            # Actions which override `process()` itself (such as
+            # ActionTartarusEncounters) don't follow the usual use_default
+            # rules, so just call through to them.
+            return lambda default: str(action.process(name, default, use_default=use_default))
+        if use_default or action.use_default:
+            return lambda default: default
+        if isinstance(action, ActionHardcode):
+            val = str(action.val)
+            return lambda default: val
+        if isinstance(action, ActionScaleFloat):
+            scale = action.scale
+            precision = action.precision
+            return lambda default: str(round(float(default)*scale, precision))
+        if isinstance(action, ActionScaleInt):
+            scale = action.scale
+            return lambda default: str(math.floor(float(default)*scale + 0.5))
+        # Anything else (GodMode, Fishing, ForceBiomeDepth...) gets its
+        # `_process` called directly, since we've already handled the
+        # use_default checks above.
+        return lambda default: str(action._process(name, default))
+
+    @staticmethod
+    def _default_resolver(default):
+        """
+        Resolver used for macros which don't show up in our changes dict
+        at all -- just passes the template default through.
+        """
+        return default
+
+    def _iter_files(self, dirname):
+        """
+        Recursively yield the full paths of all files under `dirname`.
+        os.scandir gets the file-vs-dir info from the directory entries
+        themselves, so this skips the extra stat calls os.walk would do.
+        """
+        for entry in os.scandir(dirname):
+            if entry.is_dir(follow_symlinks=False):
+                yield from self._iter_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path
 
     def process_files(self, use_defaults=False):
         """
-        Process all files in our template dir
+        Process all files in our template dir.  Each file is entirely
+        independent of the others, so farm the work out to a thread pool --
+        the heavy lifting (encoding/decoding and disk I/O) happens in C and
+        releases the GIL.
         """
-        for dirpath, _, filenames in os.walk(self.template_dir):
-            for filename in filenames:
-                self.process_file(os.path.join(dirpath, filename)[len(self.template_dir)+1:], use_defaults)
+        prefix_len = len(self.template_dir)+1
+        filenames = [path[prefix_len:] for path in self._iter_files(self.template_dir)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()*2) as ex:
+            # Wrapping in list() makes sure any worker exceptions get raised
+            list(ex.map(lambda filename: self.process_file(filename, use_defaults), filenames))
 
     def process_file(self, filename, use_defaults=False):
         """
@@ -460,7 +589,8 @@ class App:
         dir.
         """
 
-        print(f'Processing: {filename}')
+        with self._print_lock:
+            print(f'Processing: {filename}')
 
         # Figure out paths and make sure we can write to the live dir.
         filename_template = os.path.join(self.template_dir, filename)
@@ -469,28 +599,45 @@ class App:
         if not os.path.exists(dirname_live):
             os.makedirs(dirname_live, exist_ok=True)
 
+        # If there aren't any macros in the file at all, there's no point in
+        # doing any text processing -- just copy it over verbatim.
+        with open(filename_template, 'rb') as df:
+            raw = df.read()
+        if b'@' not in raw:
+            shutil.copyfile(filename_template, filename_live)
+            return
+
         # Loop through and look for our macros
-        with TextProcessor(filename_template, filename_live) as tp:
+        resolvers = self._defaults_resolvers if use_defaults else self._resolvers
+        with TextProcessor(filename_template, filename_live, raw=raw) as tp:
             for line in tp:
-                if match := self.macro_re.match(line):
-                    start = match.group('start')
-                    name = match.group('name')
-                    default = match.group('default')
-                    end = match.group('end')
-                    if name in self.changes:
-                        action = self.changes[name]
-                    elif name in self.required_macros:
-                        raise RuntimeError(f'Macro "{name}" is not present in the action list; this is required!')
-                    else:
-                        print(f' - WARNING: Change key not found, using default: {name}')
-                        action = self.default_action
-                    tp.write('{}{}{}'.format(
-                        start,
-                        action.process(name, default, use_default=use_defaults),
-                        end,
-                        ))
-                else:
+                # The vast majority of lines have no macro in them at all, so
+                # check for that cheaply before bothering to parse anything out.
+                # (Our macro format doesn't support more than one per line.)
+                if '@' not in line:
+                    tp.write(line)
+                    continue
+                i = line.find('@')
+                j = line.find('|', i+1)
+                k = line.find('@', j+1)
+                if j == -1 or k == -1 or not macro_name_re.fullmatch(line, i+1, j):
                     tp.write(line)
+                else:
+                    start = line[:i]
+                    name = line[i+1:j]
+                    default = line[j+1:k]
+                    end = line[k+1:]
+                    if (resolver := resolvers.get(name)) is None:
+                        if name in self.required_macros:
+                            raise RuntimeError(f'Macro "{name}" is not present in the action list; this is required!')
+                        with self._print_lock:
+                            print(f' - WARNING: Change key not found, using default: {name}')
+                        resolver = self._default_resolver
+                    key = (name, default, use_defaults)
+                    if (val := self._value_cache.get(key)) is None:
+                        val = resolver(default)
+                        self._value_cache[key] = val
+                    tp.write(f'{start}{val}{end}')
 
 def main():
 